@@ -30,11 +30,12 @@ import logging
 import os
 import pickle
 import time
-from typing import Any, Dict, List, Optional, Tuple, TYPE_CHECKING
+from typing import Any, Dict, List, Optional, Tuple, Union, TYPE_CHECKING
 
 import numpy as np
 
 from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.utils.validation import check_memory
 
 from art.config import ART_DATA_PATH
 from art.data_generators import DataGenerator
@@ -45,6 +46,8 @@ from art.utils import segment_by_class
 from art.visualization import create_sprite, save_image, plot_3d
 
 if TYPE_CHECKING:
+    from joblib import Memory
+
     from art.estimators.classification.classifier import Classifier
 
 logger = logging.getLogger(__name__)
@@ -61,9 +64,19 @@ class ActivationDefence(PoisonFilteringDefence):
         in general, see https://arxiv.org/abs/1902.06705
     """
 
-    defence_params = ["nb_clusters", "clustering_method", "nb_dims", "reduce", "cluster_analysis", "generator"]
-    valid_clustering = ["KMeans"]
-    valid_reduce = ["PCA", "FastICA", "TSNE"]
+    defence_params = [
+        "nb_clusters",
+        "clustering_method",
+        "nb_dims",
+        "reduce",
+        "cluster_analysis",
+        "generator",
+        "n_jobs",
+        "memory",
+        "shared_reduction",
+    ]
+    valid_clustering = ["KMeans", "MiniBatchKMeans"]
+    valid_reduce = ["PCA", "FastICA"]
     valid_analysis = ["smaller", "distance", "relative-size", "silhouette-scores"]
 
     TOO_SMALL_ACTIVATIONS = 32  # Threshold used to print a warning when activations are not enough
@@ -90,6 +103,9 @@ class ActivationDefence(PoisonFilteringDefence):
         self.reduce = "PCA"
         self.cluster_analysis = "smaller"
         self.generator = generator
+        self.n_jobs = 1
+        self.memory: Optional[Union[str, "Memory"]] = None
+        self.shared_reduction = False
         self.activations_by_class: List[np.ndarray] = []
         self.clusters_by_class: List[np.ndarray] = []
         self.assigned_clean_by_class: List[np.ndarray] = []
@@ -153,12 +169,13 @@ class ActivationDefence(PoisonFilteringDefence):
         """
         Returns poison detected and a report.
 
-        :param clustering_method: clustering algorithm to be used. Currently `KMeans` is the only method supported
+        :param clustering_method: clustering algorithm to be used. Supported methods include `KMeans` and
+                                  `MiniBatchKMeans`, the latter being faster for classes with many data points
         :type clustering_method: `str`
         :param nb_clusters: number of clusters to find. This value needs to be greater or equal to one
         :type nb_clusters: `int`
-        :param reduce: method used to reduce dimensionality of the activations. Supported methods include  `PCA`,
-                       `FastICA` and `TSNE`
+        :param reduce: method used to reduce dimensionality of the activations. Supported methods include `PCA` and
+                       `FastICA`
         :type reduce: `str`
         :param nb_dims: number of dimensions to be reduced
         :type nb_dims: `int`
@@ -252,6 +269,8 @@ class ActivationDefence(PoisonFilteringDefence):
                     clustering_method=self.clustering_method,
                     generator=self.generator,
                     clusterer_new=self.clusterer,
+                    memory=self.memory,
+                    shared_reduction=self.shared_reduction,
                 )
 
                 for class_idx in range(num_classes):
@@ -276,6 +295,9 @@ class ActivationDefence(PoisonFilteringDefence):
             nb_dims=self.nb_dims,
             reduce=self.reduce,
             clustering_method=self.clustering_method,
+            memory=self.memory,
+            n_jobs=self.n_jobs,
+            shared_reduction=self.shared_reduction,
         )
 
         return self.clusters_by_class, self.red_activations_by_class
@@ -552,6 +574,10 @@ class ActivationDefence(PoisonFilteringDefence):
             )
         if self.nb_dims <= 0:
             raise ValueError("Wrong number of dimensions.")
+        if not isinstance(self.n_jobs, int) or self.n_jobs == 0:
+            raise ValueError("Wrong number of jobs, should be a non-zero integer. Provided: " + str(self.n_jobs))
+        if not isinstance(self.shared_reduction, bool):
+            raise TypeError("Shared reduction must be a boolean.")
         if self.clustering_method not in self.valid_clustering:
             raise ValueError("Unsupported clustering method: " + self.clustering_method)
         if self.reduce not in self.valid_reduce:
@@ -655,10 +681,13 @@ def cluster_activations(
     separated_activations: List[np.ndarray],
     nb_clusters: int = 2,
     nb_dims: int = 10,
-    reduce: str = "FastICA",
+    reduce: str = "PCA",
     clustering_method: str = "KMeans",
     generator: Optional[DataGenerator] = None,
     clusterer_new: Optional[MiniBatchKMeans] = None,
+    memory: Optional[Union[str, "Memory"]] = None,
+    n_jobs: int = 1,
+    shared_reduction: bool = False,
 ) -> Tuple[List[np.ndarray], List[np.ndarray]]:
     """
     Clusters activations and returns two arrays.
@@ -666,59 +695,185 @@ def cluster_activations(
     in the class has been assigned.
     2) separated_reduced_activations: activations with dimensionality reduced using the specified reduce method.
 
+    The activations of all classes are stacked and clustered with `cluster_activations_stacked`. By default the
+    dimensionality reduction is fitted on each class separately, see `shared_reduction`.
+
     :param separated_activations: List where separated_activations[i] is a np matrix for the ith class where
            each row corresponds to activations for a given data point.
     :param nb_clusters: number of clusters (defaults to 2 for poison/clean).
     :param nb_dims: number of dimensions to reduce activation to via PCA.
-    :param reduce: Method to perform dimensionality reduction, default is FastICA.
-    :param clustering_method: Clustering method to use, default is KMeans.
+    :param reduce: Method to perform dimensionality reduction, default is PCA (computed with a randomized SVD).
+    :param clustering_method: Clustering method to use, either `KMeans` or `MiniBatchKMeans`, default is KMeans.
     :param generator: whether or not a the activations are a batch or full activations
-    :return: (separated_clusters, separated_reduced_activations).
     :param clusterer_new: whether or not a the activations are a batch or full activations
+    :param memory: Path to a caching directory or `joblib.Memory` object used to cache the dimensionality reduction
+           across calls with the same activations, e.g. when sweeping over `nb_clusters`. By default no caching is done.
+    :param n_jobs: Number of parallel jobs used to cluster the classes, `-1` uses all processors. Ignored when a
+           `generator` is used. Default is 1, which clusters the classes sequentially.
+    :param shared_reduction: Whether to fit a single dimensionality reduction on the activations of all classes instead
+           of one per class. Faster, but the reduced activations and therefore the clusters are different.
     :return: (separated_clusters, separated_reduced_activations)
     """
-    separated_clusters = []
-    separated_reduced_activations = []
+    class_offsets = np.cumsum([0] + [len(activation) for activation in separated_activations])
+
+    clusters, reduced_activations = cluster_activations_stacked(
+        np.vstack(separated_activations),
+        class_offsets,
+        nb_clusters=nb_clusters,
+        nb_dims=nb_dims,
+        reduce=reduce,
+        clustering_method=clustering_method,
+        generator=generator,
+        clusterer_new=clusterer_new,
+        memory=memory,
+        n_jobs=n_jobs,
+        shared_reduction=shared_reduction,
+    )
+    separated_clusters = np.split(clusters, class_offsets[1:-1])
+    separated_reduced_activations = np.split(reduced_activations, class_offsets[1:-1])
 
-    if clustering_method == "KMeans":
-        clusterer = KMeans(n_clusters=nb_clusters)
-    else:
+    return separated_clusters, separated_reduced_activations
+
+
+def cluster_activations_stacked(
+    stacked_activations: np.ndarray,
+    class_offsets: np.ndarray,
+    nb_clusters: int = 2,
+    nb_dims: int = 10,
+    reduce: str = "PCA",
+    clustering_method: str = "KMeans",
+    generator: Optional[DataGenerator] = None,
+    clusterer_new: Optional[MiniBatchKMeans] = None,
+    memory: Optional[Union[str, "Memory"]] = None,
+    n_jobs: int = 1,
+    shared_reduction: bool = False,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Clusters activations stored in a single array, where the activations of the ith class are the rows
+    `stacked_activations[class_offsets[i]:class_offsets[i + 1]]`. Returns two arrays with the same row order.
+    1) clusters: 1D array indicating which cluster of its class each datapoint has been assigned.
+    2) reduced_activations: activations with dimensionality reduced using the specified reduce method.
+
+    By default the dimensionality reduction is fitted on the activations of each class separately, so the kept
+    components follow the variance within the class where clean and poisonous data points separate. With
+    `shared_reduction=True` it is fitted once on the whole array, which is faster but keeps the directions separating
+    the classes and therefore changes the results of the defence. Each class is then clustered on its slice of the
+    reduced activations.
+
+    :param stacked_activations: Matrix where each row corresponds to activations for a given data point, ordered by
+           class.
+    :param class_offsets: Array of length `nb_classes + 1` with the index of the first row of each class followed by
+           the total number of rows.
+    :param nb_clusters: number of clusters (defaults to 2 for poison/clean).
+    :param nb_dims: number of dimensions to reduce activation to via PCA.
+    :param reduce: Method to perform dimensionality reduction, default is PCA (computed with a randomized SVD).
+    :param clustering_method: Clustering method to use, either `KMeans` or `MiniBatchKMeans`, default is KMeans.
+    :param generator: whether or not a the activations are a batch or full activations
+    :param clusterer_new: whether or not a the activations are a batch or full activations
+    :param memory: Path to a caching directory or `joblib.Memory` object used to cache the dimensionality reduction
+           across calls with the same activations, e.g. when sweeping over `nb_clusters`. By default no caching is done.
+    :param n_jobs: Number of parallel jobs used to cluster the classes, `-1` uses all processors. Ignored when a
+           `generator` is used. Default is 1, which clusters the classes sequentially.
+    :param shared_reduction: Whether to fit a single dimensionality reduction on the activations of all classes instead
+           of one per class. Faster, but the reduced activations and therefore the clusters are different.
+    :return: (clusters, reduced_activations)
+    """
+    reduce_dimensionality_cached = check_memory(memory).cache(reduce_dimensionality)
+
+    if clustering_method not in ActivationDefence.valid_clustering:
         raise ValueError(clustering_method + " clustering method not supported.")
+    # Checked here since the reduction is skipped for activations with at most nb_dims features
+    if reduce not in ActivationDefence.valid_reduce:
+        raise ValueError(reduce + " dimensionality reduction method not supported.")
 
-    for activation in separated_activations:
-        # Apply dimensionality reduction
-        nb_activations = np.shape(activation)[1]
-        if nb_activations > nb_dims:
-            # TODO: address issue where if fewer samples than nb_dims this fails
-            reduced_activations = reduce_dimensionality(activation, nb_dims=nb_dims, reduce=reduce)
+    class_offsets = np.asarray(class_offsets)
+    if class_offsets[0] != 0 or class_offsets[-1] != len(stacked_activations) or np.any(np.diff(class_offsets) < 0):
+        raise ValueError("Class offsets must be non-decreasing, start at 0 and end at the number of activations.")
+
+    # Classes without any data point have nothing to reduce or cluster
+    class_slices = [slice(start, end) for start, end in zip(class_offsets[:-1], class_offsets[1:]) if end > start]
+
+    # Apply dimensionality reduction
+    all_activations = np.ascontiguousarray(stacked_activations, dtype=np.float32)
+    nb_activations = all_activations.shape[1]
+    if nb_activations > nb_dims:
+        # TODO: address issue where if fewer samples than nb_dims this fails
+        if shared_reduction:
+            all_reduced_activations = reduce_dimensionality_cached(all_activations, nb_dims=nb_dims, reduce=reduce)
+            # Clustering is considerably faster on C-ordered single precision data
+            all_reduced_activations = np.ascontiguousarray(all_reduced_activations, dtype=np.float32)
         else:
-            logger.info(
-                "Dimensionality of activations = %i less than nb_dims = %i. Not applying dimensionality " "reduction.",
-                nb_activations,
-                nb_dims,
+            all_reduced_activations = np.empty((len(all_activations), nb_dims), dtype=np.float32)
+            for class_slice in class_slices:
+                all_reduced_activations[class_slice] = reduce_dimensionality_cached(
+                    all_activations[class_slice], nb_dims=nb_dims, reduce=reduce
+                )
+    else:
+        # No projector is created at all, the activations are clustered as they are
+        logger.warning(
+            "Dimensionality of activations = %i less than nb_dims = %i. Not applying dimensionality " "reduction.",
+            nb_activations,
+            nb_dims,
+        )
+        all_reduced_activations = all_activations
+
+    # Get cluster assignments, written in place into a single preallocated array
+    clusters = np.empty(len(all_reduced_activations), dtype=np.int32)
+    if generator is not None and clusterer_new is not None:
+        # The shared clusterer is updated incrementally, so the classes have to be processed sequentially
+        for class_slice in class_slices:
+            clusterer_new = clusterer_new.partial_fit(all_reduced_activations[class_slice])
+            # NOTE: this may cause earlier predictions to be less accurate
+            clusters[class_slice] = clusterer_new.predict(all_reduced_activations[class_slice])
+    elif n_jobs == 1 or len(class_slices) == 1:
+        for class_slice in class_slices:
+            clusters[class_slice] = _cluster_class(
+                all_reduced_activations[class_slice], nb_clusters=nb_clusters, clustering_method=clustering_method
             )
-            reduced_activations = activation
-        separated_reduced_activations.append(reduced_activations)
+    else:
+        from joblib import Parallel, delayed
 
-        # Get cluster assignments
-        if generator is not None and clusterer_new is not None:
-            clusterer_new = clusterer_new.partial_fit(reduced_activations)
-            # NOTE: this may cause earlier predictions to be less accurate
-            clusters = clusterer_new.predict(reduced_activations)
-        else:
-            clusters = clusterer.fit_predict(reduced_activations)
-        separated_clusters.append(clusters)
+        # Classes are independent of each other and can be clustered in parallel
+        separated_clusters = Parallel(n_jobs=n_jobs, backend="loky")(
+            delayed(_cluster_class)(
+                all_reduced_activations[class_slice], nb_clusters=nb_clusters, clustering_method=clustering_method
+            )
+            for class_slice in class_slices
+        )
+        for class_slice, class_clusters in zip(class_slices, separated_clusters):
+            clusters[class_slice] = class_clusters
 
-    return separated_clusters, separated_reduced_activations
+    return clusters, all_reduced_activations
+
+
+def _cluster_class(
+    reduced_activations: np.ndarray, nb_clusters: int = 2, clustering_method: str = "KMeans"
+) -> np.ndarray:
+    """
+    Clusters the reduced activations of a single class with a newly created clusterer.
+
+    :param reduced_activations: Reduced activations of the class, one row per data point.
+    :param nb_clusters: number of clusters (defaults to 2 for poison/clean).
+    :param clustering_method: Clustering method to use, either `KMeans` or `MiniBatchKMeans`, default is KMeans. It
+           is validated by `cluster_activations_stacked`.
+    :return: Array with the cluster assigned to each data point.
+    """
+    if clustering_method == "KMeans":
+        # Elkan's algorithm saves most distance computations on the low dimensional reduced activations
+        clusterer = KMeans(n_clusters=nb_clusters, algorithm="elkan", n_init=3, random_state=0)
+    else:
+        clusterer = MiniBatchKMeans(n_clusters=nb_clusters, batch_size=1024, n_init=3, random_state=0)
+
+    return clusterer.fit_predict(reduced_activations)
 
 
-def reduce_dimensionality(activations: np.ndarray, nb_dims: int = 10, reduce: str = "FastICA") -> np.ndarray:
+def reduce_dimensionality(activations: np.ndarray, nb_dims: int = 10, reduce: str = "PCA") -> np.ndarray:
     """
     Reduces dimensionality of the activations provided using the specified number of dimensions and reduction technique.
 
     :param activations: Activations to be reduced.
     :param nb_dims: number of dimensions to reduce activation to via PCA.
-    :param reduce: Method to perform dimensionality reduction, default is FastICA.
+    :param reduce: Method to perform dimensionality reduction, default is PCA (computed with a randomized SVD).
     :return: Array with the reduced activations.
     """
     # pylint: disable=E0001
@@ -727,7 +882,7 @@ def reduce_dimensionality(activations: np.ndarray, nb_dims: int = 10, reduce: st
     if reduce == "FastICA":
         projector = FastICA(n_components=nb_dims, max_iter=1000, tol=0.005)
     elif reduce == "PCA":
-        projector = PCA(n_components=nb_dims)
+        projector = PCA(n_components=nb_dims, svd_solver="randomized", random_state=0)
     else:
         raise ValueError(reduce + " dimensionality reduction method not supported.")
 
@@ -1,3 +1,5 @@
+import functools
+import hashlib
 import logging
 import pytest
 import numpy as np
@@ -10,6 +12,9 @@ import shutil
 from tests.utils import master_seed, get_image_classifier_kr, get_image_classifier_tf, get_image_classifier_pt
 from tests.utils import get_tabular_classifier_kr, get_tabular_classifier_tf, get_tabular_classifier_pt
 from tests.utils import get_tabular_classifier_scikit_list, load_dataset
+import art.utils
+from art.config import ART_DATA_PATH
+from art.defences.preprocessor import FeatureSqueezing
 from art.estimators.classification import KerasClassifier
 
 logger = logging.getLogger(__name__)
@@ -17,6 +22,101 @@ art_supported_frameworks = ["keras", "tensorflow", "pytorch", "scikitlearn"]
 
 master_seed(1234)
 
+DATASET_CACHE_KEYS = ["x_train", "y_train", "x_test", "y_test"]
+# Increase when the layout or the content of the cached files changes, to invalidate existing caches
+DATASET_CACHE_VERSION = 2
+# Seed of the shuffling done by some dataset loaders, e.g. iris, when the cache is built
+DATASET_CACHE_SEED = 1234
+DATASET_SOURCE_FILES = {"iris": "iris.data", "mnist": "mnist.npz"}
+
+
+def dataset_cache_dir(name, source_path):
+    """
+    Returns the cache folder of a preprocessed dataset. Its name contains a digest of the cache version, of the ART
+    module loading and preprocessing the datasets and of the downloaded source file, so that a change to any of them
+    creates a new cache instead of reusing stale arrays.
+
+    :param name: Name of the dataset, as accepted by `load_dataset`.
+    :param source_path: Path of the downloaded source file of the dataset.
+    :return: Path of the cache folder.
+    """
+    digest = hashlib.blake2b(str(DATASET_CACHE_VERSION).encode(), digest_size=8)
+    with open(art.utils.__file__, "rb") as f:
+        digest.update(f.read())
+    source_stat = os.stat(source_path)
+    digest.update("{}-{}".format(source_stat.st_mtime_ns, source_stat.st_size).encode())
+    return os.path.join(ART_DATA_PATH, "test_cache", "{}-{}".format(name, digest.hexdigest()))
+
+
+def load_dataset_seeded(name):
+    """
+    Loads a dataset with `load_dataset` under a fixed seed and restores the global numpy random state afterwards, so
+    that the cached arrays do not depend on the tests run before and that cold and warm caches leave the random state
+    unchanged alike.
+
+    :param name: Name of the dataset, as accepted by `load_dataset`.
+    :return: `(x_train, y_train), (x_test, y_test), min, max`.
+    """
+    random_state = np.random.get_state()
+    np.random.seed(DATASET_CACHE_SEED)
+    try:
+        return load_dataset(name)
+    finally:
+        np.random.set_state(random_state)
+
+
+@functools.lru_cache(maxsize=None)
+def load_dataset_cached(name):
+    """
+    Loads a dataset with `load_dataset` and keeps the preprocessed arrays in `ART_DATA_PATH`, so that later test
+    sessions memory-map them instead of preprocessing the dataset again.
+
+    :param name: Name of the dataset, either `iris` or `mnist`.
+    :return: `(x_train, y_train), (x_test, y_test)`.
+    """
+    source_path = os.path.join(ART_DATA_PATH, DATASET_SOURCE_FILES[name])
+    dataset = None
+    if not os.path.isfile(source_path):
+        # Downloads the source file, which is needed to locate the cache
+        dataset = load_dataset_seeded(name)
+
+    cache_dir = dataset_cache_dir(name, source_path)
+    paths = [os.path.join(cache_dir, key + ".npy") for key in DATASET_CACHE_KEYS]
+
+    if not all(os.path.isfile(path) for path in paths):
+        logger.info("Caching preprocessed %s dataset in %s", name, cache_dir)
+        if dataset is None:
+            dataset = load_dataset_seeded(name)
+        (x_train, y_train), (x_test, y_test), _, _ = dataset
+        os.makedirs(cache_dir, exist_ok=True)
+        for path, array in zip(paths, [x_train, y_train, x_test, y_test]):
+            # Every writer uses its own temporary file, renamed once complete, so that concurrent test sessions never
+            # read a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".npy")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    np.save(f, array)
+                os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+    # Copy-on-write mapping: pages are shared between test processes and the files are never modified
+    x_train, y_train, x_test, y_test = [np.load(path, mmap_mode="c") for path in paths]
+    return (x_train, y_train), (x_test, y_test)
+
+
+def hash_array(array):
+    """
+    Computes a digest of the content of an array, used to check that test data has not been modified without keeping
+    a copy of it.
+
+    :param array: Array to be hashed.
+    :return: Hexadecimal digest.
+    """
+    return hashlib.blake2b(np.ascontiguousarray(array), digest_size=16).hexdigest()
+
 
 def pytest_addoption(parser):
     parser.addoption(
@@ -32,7 +132,7 @@ def get_image_classifier_list_defended(framework):
         sess = None
         classifier_list = None
         if framework == "keras":
-            classifier = utils.get_image_classifier_kr()
+            classifier = get_image_classifier_kr()
             # Get the ready-trained Keras model
             fs = FeatureSqueezing(bit_depth=1, clip_values=(0, 1))
             classifier_list = [KerasClassifier(model=classifier._model, clip_values=(0, 1), preprocessing_defences=fs)]
@@ -204,7 +304,7 @@ def is_tf_version_2():
 @pytest.fixture(scope="session")
 def load_iris_dataset():
     logging.info("Loading Iris dataset")
-    (x_train_iris, y_train_iris), (x_test_iris, y_test_iris), _, _ = load_dataset('iris')
+    (x_train_iris, y_train_iris), (x_test_iris, y_test_iris) = load_dataset_cached('iris')
 
     yield (x_train_iris, y_train_iris), (x_test_iris, y_test_iris)
 
@@ -213,17 +313,12 @@ def load_iris_dataset():
 def get_iris_dataset(load_iris_dataset, framework):
     (x_train_iris, y_train_iris), (x_test_iris, y_test_iris) = load_iris_dataset
 
-    x_train_iris_original = x_train_iris.copy()
-    y_train_iris_original = y_train_iris.copy()
-    x_test_iris_original = x_test_iris.copy()
-    y_test_iris_original = y_test_iris.copy()
+    arrays = [x_train_iris, y_train_iris, x_test_iris, y_test_iris]
+    hashes_original = [hash_array(array) for array in arrays]
 
     yield (x_train_iris, y_train_iris), (x_test_iris, y_test_iris)
 
-    np.testing.assert_array_almost_equal(x_train_iris_original, x_train_iris, decimal=3)
-    np.testing.assert_array_almost_equal(y_train_iris_original, y_train_iris, decimal=3)
-    np.testing.assert_array_almost_equal(x_test_iris_original, x_test_iris, decimal=3)
-    np.testing.assert_array_almost_equal(y_test_iris_original, y_test_iris, decimal=3)
+    assert [hash_array(array) for array in arrays] == hashes_original, "Iris test data has been modified"
 
 
 @pytest.fixture(scope="session")
@@ -242,9 +337,19 @@ def get_default_mnist_subset(get_mnist_dataset, default_dataset_subset_sizes):
 
 
 @pytest.fixture(scope="session")
-def load_mnist_dataset():
+def load_mnist_dataset(framework):
     logging.info("Loading mnist")
-    (x_train_mnist, y_train_mnist), (x_test_mnist, y_test_mnist), _, _ = load_dataset('mnist')
+    (x_train_mnist, y_train_mnist), (x_test_mnist, y_test_mnist) = load_dataset_cached('mnist')
+
+    # Convert to the channels first float32 layout of the pytorch classifiers once per session instead of per test
+    if framework == "pytorch":
+        if x_train_mnist.dtype != np.float32:
+            x_train_mnist = x_train_mnist.astype(np.float32, copy=False)
+        if x_test_mnist.dtype != np.float32:
+            x_test_mnist = x_test_mnist.astype(np.float32, copy=False)
+        x_train_mnist = np.ascontiguousarray(x_train_mnist.reshape(-1, 1, 28, 28))
+        x_test_mnist = np.ascontiguousarray(x_test_mnist.reshape(-1, 1, 28, 28))
+
     yield (x_train_mnist, y_train_mnist), (x_test_mnist, y_test_mnist)
 
 
@@ -256,25 +361,16 @@ def create_test_dir():
 
 
 @pytest.fixture(scope="function")
-def get_mnist_dataset(load_mnist_dataset, framework):
+def get_mnist_dataset(load_mnist_dataset):
     (x_train_mnist, y_train_mnist), (x_test_mnist, y_test_mnist) = load_mnist_dataset
 
-    if framework == "pytorch":
-        x_train_mnist = np.reshape(x_train_mnist, (x_train_mnist.shape[0], 1, 28, 28)).astype(np.float32)
-        x_test_mnist = np.reshape(x_test_mnist, (x_test_mnist.shape[0], 1, 28, 28)).astype(np.float32)
-
-    x_train_mnist_original = x_train_mnist.copy()
-    y_train_mnist_original = y_train_mnist.copy()
-    x_test_mnist_original = x_test_mnist.copy()
-    y_test_mnist_original = y_test_mnist.copy()
+    arrays = [x_train_mnist, y_train_mnist, x_test_mnist, y_test_mnist]
+    hashes_original = [hash_array(array) for array in arrays]
 
     yield (x_train_mnist, y_train_mnist), (x_test_mnist, y_test_mnist)
 
     # Check that the test data has not been modified, only catches changes in attack.generate if self has been used
-    np.testing.assert_array_almost_equal(x_train_mnist_original, x_train_mnist, decimal=3)
-    np.testing.assert_array_almost_equal(y_train_mnist_original, y_train_mnist, decimal=3)
-    np.testing.assert_array_almost_equal(x_test_mnist_original, x_test_mnist, decimal=3)
-    np.testing.assert_array_almost_equal(y_test_mnist_original, y_test_mnist, decimal=3)
+    assert [hash_array(array) for array in arrays] == hashes_original, "MNIST test data has been modified"
 
 
 # ART test fixture to skip test for specific mlFramework values
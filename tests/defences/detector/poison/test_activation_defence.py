@@ -18,6 +18,9 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import logging
+import os
+import shutil
+import tempfile
 import unittest
 
 from keras_preprocessing.image import ImageDataGenerator
@@ -25,6 +28,7 @@ import numpy as np
 
 from art.data_generators import KerasDataGenerator
 from art.defences.detector.poison import ActivationDefence
+from art.defences.detector.poison.activation_defence import cluster_activations, cluster_activations_stacked
 from art.utils import load_mnist
 from art.visualization import convert_to_rgb
 
@@ -94,6 +98,10 @@ class TestActivationDefence(unittest.TestCase):
     def test_wrong_parameters_4(self):
         self.defence.set_params(cluster_analysis="what")
 
+    @unittest.expectedFailure
+    def test_wrong_parameters_5(self):
+        self.defence.set_params(n_jobs=0)
+
     def test_activations(self):
         (x_train, _), (_, _), (_, _) = self.mnist
         activations = self.defence._get_activations()
@@ -118,6 +126,104 @@ class TestActivationDefence(unittest.TestCase):
                 n_dp += len(clusters_by_class[i])
             self.assertEqual(len(x_train), n_dp)
 
+    def test_output_clusters_mini_batch(self):
+        # Get MNIST
+        (x_train, _), (_, _), (_, _) = self.mnist
+
+        n_classes = self.classifier.nb_classes
+        clusters_by_class, _ = self.defence.cluster_activations(nb_clusters=2, clustering_method="MiniBatchKMeans")
+        self.defence.set_params(clustering_method="KMeans")
+
+        # Verify expected number of classes
+        self.assertEqual(np.shape(clusters_by_class)[0], n_classes)
+        # Check we get the expected number of clusters:
+        found_clusters = len(np.unique(clusters_by_class[0]))
+        self.assertEqual(found_clusters, 2)
+        # Check right amount of data
+        n_dp = 0
+        for i in range(0, n_classes):
+            n_dp += len(clusters_by_class[i])
+        self.assertEqual(len(x_train), n_dp)
+
+    def test_cluster_activations_stacked(self):
+        rng = np.random.RandomState(1234)
+        # Class 0 has two blobs in consecutive rows, class 1 is empty and class 2 has two interleaved blobs
+        class_0 = np.vstack([rng.normal(-5.0, 0.1, size=(10, 3)), rng.normal(5.0, 0.1, size=(10, 3))])
+        class_2 = rng.normal(20.0, 0.1, size=(30, 3))
+        class_2[1::2, 1] += 10.0
+        stacked_activations = np.vstack([class_0, np.empty((0, 3)), class_2])
+        class_offsets = np.array([0, 20, 20, 50])
+
+        clusters, red_activations = cluster_activations_stacked(stacked_activations, class_offsets, nb_dims=10)
+
+        # Activations are not reduced since they have fewer features than nb_dims, rows must keep their order
+        self.assertEqual(clusters.shape, (50,))
+        np.testing.assert_array_almost_equal(red_activations, stacked_activations, decimal=4)
+
+        # Check each class slice is partitioned according to its blobs
+        clusters_0 = clusters[0:20]
+        self.assertEqual(len(np.unique(clusters_0[:10])), 1)
+        self.assertEqual(len(np.unique(clusters_0[10:])), 1)
+        self.assertNotEqual(clusters_0[0], clusters_0[10])
+        clusters_2 = clusters[20:50]
+        self.assertEqual(len(np.unique(clusters_2[0::2])), 1)
+        self.assertEqual(len(np.unique(clusters_2[1::2])), 1)
+        self.assertNotEqual(clusters_2[0], clusters_2[1])
+
+        # The list interface returns the same assignments split per class, including the empty class
+        clusters_by_class, _ = cluster_activations([class_0, np.empty((0, 3)), class_2], nb_dims=10)
+        self.assertEqual(len(clusters_by_class), 3)
+        self.assertEqual(len(clusters_by_class[1]), 0)
+        np.testing.assert_array_equal(clusters_by_class[0], clusters_0)
+        np.testing.assert_array_equal(clusters_by_class[2], clusters_2)
+
+    def test_cluster_activations_memory(self):
+        def count_cached_reductions(cache_dir):
+            # joblib stores one folder per cached call in a folder named after the cached function
+            return sum(
+                len(dir_names)
+                for dir_path, dir_names, _ in os.walk(cache_dir)
+                if os.path.basename(dir_path) == "reduce_dimensionality"
+            )
+
+        cache_dir = tempfile.mkdtemp()
+
+        try:
+            # Sweeping over nb_clusters reuses the cached reductions of the first call, one per class
+            for nb_clusters in range(2, 5):
+                clusters_by_class, _ = self.defence.cluster_activations(nb_clusters=nb_clusters, memory=cache_dir)
+                self.assertEqual(len(np.unique(clusters_by_class[0])), nb_clusters)
+                nb_classes = sum(len(activations) > 0 for activations in self.defence.activations_by_class)
+                self.assertEqual(count_cached_reductions(cache_dir), nb_classes)
+
+            # A different reduction is cached separately
+            self.defence.cluster_activations(nb_dims=5, memory=cache_dir)
+            self.assertEqual(count_cached_reductions(cache_dir), 2 * nb_classes)
+
+            # A shared reduction is a single call on the activations of all classes
+            self.defence.cluster_activations(shared_reduction=True, memory=cache_dir)
+            self.assertEqual(count_cached_reductions(cache_dir), 2 * nb_classes + 1)
+        finally:
+            self.defence.set_params(nb_clusters=2, nb_dims=10, memory=None, shared_reduction=False)
+            shutil.rmtree(cache_dir)
+
+    def test_cluster_activations_n_jobs(self):
+        activations_by_class = self.defence._segment_by_class(self.defence._get_activations(), self.defence.y_train)
+        clusters_sequential, _ = cluster_activations(activations_by_class, n_jobs=1)
+        clusters_parallel, _ = cluster_activations(activations_by_class, n_jobs=2)
+
+        for i in range(len(clusters_sequential)):
+            np.testing.assert_array_equal(clusters_sequential[i], clusters_parallel[i])
+
+    @unittest.expectedFailure
+    def test_cluster_activations_stacked_wrong_offsets(self):
+        cluster_activations_stacked(np.zeros((10, 20)), np.array([0, 4, 8]))
+
+    @unittest.expectedFailure
+    def test_cluster_activations_wrong_reduce(self):
+        # Reduction is not needed for these activations, the method still has to be validated
+        cluster_activations([np.zeros((10, 5)), np.ones((10, 5))], nb_dims=10, reduce="what")
+
     def test_detect_poison(self):
         # Get MNIST
         (x_train, _), (_, _), (_, _) = self.mnist